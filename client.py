@@ -1,8 +1,16 @@
-import socket, sys, logging, json
+import socket, sys, logging, json, zlib, base64
 if sys.version_info[0] > 2:
     import urllib.parse as urllib
 else:
     import urllib
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # If you would like to use via commandline, it is recommended to run this
 # file with the -i command: `python -i client.py`. This will setup basic
@@ -14,6 +22,29 @@ DEFAULT_HOST = 'localhost'
 DEFAULT_PORT = 36577
 DEFAULT_TIMEOUT = 2
 
+# Decompressors for codecs this client can accept (see server.py for protocol)
+CODECS = {'zlib':zlib.decompressobj}
+if lz4:
+    CODECS['lz4'] = lz4.frame.LZ4FrameDecompressor
+DEFAULT_COMPRESS = [codec for codec in ('lz4','zlib') if codec in CODECS]
+
+# Decoders for tagged values sent to typed clients, keyed by tag (see utils.register_encoder)
+DECODERS = {'__complex__':lambda obj: complex(*obj['__complex__'])}
+if numpy:
+    DECODERS['__ndarray__'] = lambda obj: numpy.frombuffer(bytearray(base64.b64decode(obj['__ndarray__'])),
+                                                           dtype=obj['dtype']).reshape(obj['shape'])
+
+def register_decoder(tag,fn):
+    """ Decode json objects with a "__<tag>__" field with `fn` when using typed clients
+    """
+    DECODERS['__%s__'%tag] = fn
+
+def _decode_typed(obj):
+    for key in obj:
+        if key in DECODERS:
+            return DECODERS[key](obj)
+    return obj
+
 class client:
     """ Connect with server.py on host machine to control various pieces of equipment
        
@@ -23,21 +54,48 @@ class client:
             Hostname or IP of server.
         port : int
             Port number on `host`.
+        unix_path : str or None
+            Path of the server's unix domain socket. If set, it is used instead of `host`
+            and `port` (the server must be on this machine and started with `unix_path`).
         timeout : int, float
             Time in seconds to wait for server to reply. Same as socket.timeout.
+        compress : list of str
+            Codecs (in order of preference) the server may use to compress large responses.
+            Set to an empty list to disable compression.
+        typed : bool
+            Ask for values json can't represent (e.g. numpy arrays) as tagged objects and
+            decode them (numeric numpy arrays come back as numpy arrays if numpy is installed).
+            Otherwise they arrive as plain json (e.g. nested lists).
+        raw_bytes : int
+            Total bytes of json received after decompression.
+        wire_bytes : int
+            Total bytes received from the server. Compared with `raw_bytes` this gives the
+            compression ratio achieved.
 
         Notes
         -----
         Some ModuleServer operations could conceivably take longer than the default timeout used here.
     """
 
-    def __init__(self,host=DEFAULT_HOST,port=DEFAULT_PORT,timeout=DEFAULT_TIMEOUT):
+    def __init__(self,host=DEFAULT_HOST,port=DEFAULT_PORT,timeout=DEFAULT_TIMEOUT,compress=DEFAULT_COMPRESS,unix_path=None,typed=False):
         self.host = host
         self.port = port
+        self.unix_path = unix_path
         self.timeout = timeout
-        logger.debug('Client instance created at %s port %s.' % (host, port))
+        self.compress = list(compress)
+        self.typed = typed
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        logger.debug('Client instance created at %s.' % (unix_path or '%s port %s' % (host, port)))
 
     def __connect_socket(self):
+        if self.unix_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            logger.debug('connecting to %s' % self.unix_path)
+            sock.connect(self.unix_path)
+            return sock
+
         # Create a TCP/IP socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(self.timeout)
@@ -53,14 +111,34 @@ class client:
         logger.debug('closing socket')
         sock.close()
 
-    def __recv(self,sock,delim='\n',recv_buffer=4096):
-        buffer = ''
+    def __recv(self,sock,delim=b'\n',recv_buffer=4096):
+        buffer = [] # Urlencoded pieces, or decompressed ones once "<codec>:" was received
+        decompressor = None
+        pending = b'' # Compressed base64 not decoded yet (b64decode needs multiples of 4)
         while True:
-            data = urllib.unquote_plus(sock.recv(recv_buffer).decode())
+            data = sock.recv(recv_buffer)
             assert data, 'Srver disconnected while receiving.'
-            buffer += data
-            if data[-1] == delim:
-                msg = json.loads(buffer[0:-len(delim)])  # Remove delims
+            self.wire_bytes += len(data)
+            end = data[-1:] == delim
+            if end:
+                data = data[0:-len(delim)]  # Remove delim
+            if decompressor is None and b':' in data: # Compressed (urlencoded json has no bare ':')
+                [codec,_,data] = (b''.join(buffer)+data).partition(b':')
+                buffer = []
+                decompressor = CODECS[codec.decode()]()
+            if decompressor is None:
+                buffer.append(data)
+            else: # Decompress as it arrives rather than holding the whole message
+                data = pending + data
+                n = len(data) if end else len(data) - len(data)%4
+                buffer.append(decompressor.decompress(base64.b64decode(data[:n])))
+                pending = data[n:]
+            if end:
+                data = b''.join(buffer).decode()
+                if decompressor is None:
+                    data = urllib.unquote_plus(data)
+                self.raw_bytes += len(data)
+                msg = json.loads(data,object_hook=_decode_typed if self.typed else None)
                 if msg['error']:
                     raise Exception('Server Error: '+msg['response']+\
                         '\n|'+msg['traceback'].strip().replace('\n','\n|'))
@@ -102,7 +180,7 @@ class client:
         # keep_alive not supported by client
         
         # Prepare both parts of message in case one errors
-        handshake = json.dumps({"name":module})
+        handshake = json.dumps({"name":module,"compress":self.compress,"typed":self.typed})
         message = json.dumps({"function":funcname,
             "args":args,
             "keep_alive":False})
@@ -133,6 +211,59 @@ class client:
 
         return self.__send_and_recv(sock,message)
 
+    def stats(self):
+        """ Retrieve per-module health from worker heartbeats
+
+            Returns
+            -------
+            dict
+                Keyed by module name; includes the last progress marker, seconds since
+                the last heartbeat ("age"), whether the worker is stalled and counters.
+        """
+        sock = self.__connect_socket()
+        message = json.dumps({"name":"_stats"})
+
+        return self.__send_and_recv(sock,message)
+
+    def profile(self,module,requests=None,seconds=None,every=1,path=None):
+        """ Profile requests handled by `module`'s worker (without restarting it)
+
+            Parameters
+            ----------
+            module : str
+                Name of ModuleServer's module to profile.
+            requests : int, optional
+                Number of requests to profile.
+            seconds : int, float, optional
+                Time in seconds to profile for. If neither `requests` nor `seconds` is
+                given, the server profiles 100 requests.
+            every : int, optional
+                Only profile 1 in every `every` requests.
+            path : str, optional
+                File name in the server's `profile_dir` to dump the stats to (pstats
+                format) instead of waiting for them here.
+
+            Returns
+            -------
+            dict or str
+                "requests", "seconds", "phases" (total/mean seconds in recv, decode,
+                dispatch, encode and send) and "stats" (pstats text). If `path` is given,
+                the server's acknowledgement is returned immediately instead.
+
+            Notes
+            -----
+            Without `path`, this waits until the profile completes; unless `seconds` is
+            given, that is until enough requests are made by other clients.
+        """
+        sock = self.__connect_socket()
+        assert isinstance(module,str), 'module must be a string'
+        if path is None:
+            sock.settimeout(None if seconds is None else seconds + 1 + self.timeout)
+        message = json.dumps({"name":"_profile_"+module,"requests":requests,"seconds":seconds,
+            "every":every,"path":path,"compress":self.compress})
+
+        return self.__send_and_recv(sock,message)
+
     def reload(self,module):
         """ Force server to reload `module`
             
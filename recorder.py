@@ -0,0 +1,169 @@
+import time, json, socket, threading, argparse, traceback, sys
+from concurrent.futures import ThreadPoolExecutor
+from . import utils
+
+# Opt-in traffic recording (server.main(...,record=path)) and offline replay.
+# Recording is a JSON line per event appended by a single listener process:
+#   {"k":"hello","id":ID,"t":TIME,"ip":CLIENT_IP,"name":MODULE,"compress":[CODECS],"typed":TYPED}
+#   {"k":"req","id":ID,"t":TIME,"f":FUNCTION,"a":ARGS,"ka":KEEP_ALIVE,
+#    "dt":DISPATCH_SECONDS,"rt":SECONDS_TO_REPLY,"b":JSON_BYTES,"w":BYTES_SENT,"e":ERROR}
+# Where ID ties a worker's requests to the server hello and TIME is when the hello
+# or request was fully received. JSON_BYTES is the size of the response before compression.
+# Requests that failed (e.g. BadRequest) are recorded too, with ERROR true.
+#
+# Replay (python -m ModuleServer.recorder -h) plays sessions back against a server,
+# either at the recorded timing or as fast as possible, and reports latency/throughput.
+# With --standin, requests are replaced by calls to StandIn which sleeps for the recorded
+# dispatch time and returns a response of the recorded size (see --write-config).
+
+def record(queue,**rec):
+    # Recording should never hold up or break serving clients
+    if queue is None: return
+    rec.setdefault('t',time.time())
+    try:
+        queue.put_nowait(rec)
+    except:
+        pass
+
+def listener_process(queue,path):
+    with open(path,'a') as fid:
+        while True:
+            try:
+                rec = queue.get()
+                if rec is None: # Sentinel to tell the listener to quit.
+                    break
+                fid.write(json.dumps(rec,separators=(',',':'))+'\n')
+                if queue.empty():
+                    fid.flush()
+            except KeyboardInterrupt:
+                pass
+            except SystemExit:
+                raise
+            except:
+                print('Whoops! Problem recording:')
+                traceback.print_exc(file=sys.stderr)
+
+class StandIn:
+    # Module to replay recordings against without the hardware (see standin_config)
+    ENVELOPE = len(json.dumps({'response':'','error':False,'traceback':''})) # JSON around response
+    def dispatch(self,client_ip,fn_name,duration,size,error=False):
+        # size: JSON bytes of the recorded response
+        time.sleep(duration)
+        if error:
+            raise Exception('Recorded error in "%s"'%fn_name)
+        return 'x'*max(0,size-self.ENVELOPE)
+
+def load(path):
+    # Returns list of sessions sorted by start time; each is the hello record with its
+    # requests (in order) in the "requests" field
+    sessions = {}
+    with open(path,'r') as fid:
+        for line in fid:
+            rec = json.loads(line)
+            if rec['k'] == 'hello':
+                sessions[rec['id']] = dict(rec,requests=[])
+            elif rec['k'] == 'req' and rec['id'] in sessions:
+                sessions[rec['id']]['requests'].append(rec)
+    sessions = sorted(sessions.values(),key=lambda session:session['t'])
+    [session['requests'].sort(key=lambda req:req['t']) for session in sessions]
+    return sessions
+
+def standin_config(sessions):
+    # Server config serving every recorded module name with StandIn
+    return {name:['ModuleServer.recorder','StandIn','dispatch']
+                for name in set(session['name'] for session in sessions)}
+
+def _send(sock,msg):
+    sock.sendall((utils.urllib.quote_plus(json.dumps(msg))+'\n').encode('utf-8'))
+
+def play(session,host,port,standin=False,speed=None,timeout=10):
+    # Replay one session; returns list of (latency,error) per request
+    # speed: None to send requests back to back, else factor of the recorded gaps
+    results = []
+    hello = {'name':session['name']}
+    if session.get('compress'):
+        hello['compress'] = session['compress']
+    if not standin and session.get('typed'):
+        hello['typed'] = True
+    sock = socket.create_connection((host,port),timeout)
+    try:
+        tstart = time.time()
+        _send(sock,hello)
+        if utils.recv(sock,time_out=timeout,compressed=True)['response'] != 'ack':
+            raise utils.BadRequest('No ack for "%s"'%session['name'])
+        for req in session['requests']:
+            if speed:
+                time.sleep(max(0,tstart + (req['t']-session['t'])/speed - time.time()))
+            args = [req['dt'],req['b'],req['e']] if standin else req['a']
+            t = time.time()
+            _send(sock,{'function':req['f'],'args':args,'keep_alive':req['ka']})
+            resp = utils.recv(sock,time_out=timeout,compressed=True)
+            results.append((time.time()-t,resp['error']))
+            if resp['error']: # Worker closes connection on error
+                break
+        if session['requests'] and session['requests'][-1]['ka']:
+            _send(sock,{'function':None,'args':[],'keep_alive':False})
+    finally:
+        sock.close()
+    return results
+
+def _summary(latencies):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    pick = lambda p: latencies[min(len(latencies)-1,int(p*len(latencies)))]
+    return {'mean':sum(latencies)/len(latencies),'p50':pick(0.5),'p90':pick(0.9),
+            'p99':pick(0.99),'max':latencies[-1]}
+
+def replay(sessions,host='localhost',port=36577,standin=False,speed=1.0,concurrency=8,timeout=10):
+    # speed: None to replay as fast as possible (sessions limited by concurrency), else
+    #   factor of recorded timing (e.g. 2 is twice as fast); sessions start on schedule
+    latencies = []
+    errors = [0] # [requests with error] (list to modify in threads)
+    failed = [] # Sessions that could not be replayed
+    lock = threading.Lock()
+    def run(session):
+        try:
+            results = play(session,host,port,standin,speed,timeout)
+        except Exception as err:
+            with lock: failed.append('%s: %s'%(session['name'],err))
+            return
+        with lock:
+            latencies.extend(latency for latency,error in results)
+            errors[0] += sum(error for latency,error in results)
+    if not sessions:
+        raise ValueError('Nothing to replay')
+    workers = len(sessions) if speed else concurrency
+    tstart = time.time()
+    with ThreadPoolExecutor(max_workers=max(1,min(workers,256))) as pool:
+        for session in sessions:
+            if speed:
+                time.sleep(max(0,tstart + (session['t']-sessions[0]['t'])/speed - time.time()))
+            pool.submit(run,session)
+    duration = time.time() - tstart
+    recorded = [req['rt'] for session in sessions for req in session['requests']]
+    return {'sessions':len(sessions),'requests':len(latencies),'errors':errors[0],
+            'failed_sessions':failed,'duration':duration,
+            'throughput':len(latencies)/duration if duration else None,
+            'latency':_summary(latencies),'recorded_latency':_summary(recorded)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a ModuleServer recording and report latency/throughput.')
+    parser.add_argument('recording',help='Path to recording made with server.main(...,record=path)')
+    parser.add_argument('--host',default='localhost')
+    parser.add_argument('--port',type=int,default=36577)
+    parser.add_argument('--speed',type=float,default=1.0,help='Factor of recorded timing (default 1)')
+    parser.add_argument('--fast',action='store_true',help='Ignore recorded timing and replay as fast as possible')
+    parser.add_argument('--concurrency',type=int,default=8,help='Concurrent sessions with --fast (default 8)')
+    parser.add_argument('--standin',action='store_true',help='Send StandIn args instead of recorded args')
+    parser.add_argument('--timeout',type=float,default=10)
+    parser.add_argument('--write-config',metavar='PATH',help='Write StandIn server config for recording and exit')
+    args = parser.parse_args()
+    sessions = load(args.recording)
+    if args.write_config:
+        with open(args.write_config,'w') as fid:
+            json.dump(standin_config(sessions),fid,indent=4)
+    else:
+        report = replay(sessions,args.host,args.port,args.standin,None if args.fast else args.speed,
+                        args.concurrency,args.timeout)
+        print(json.dumps(report,indent=4))
@@ -1,9 +1,9 @@
 # Built-in modules
-import os, time, json, logging, socket
+import os, stat, time, json, logging, socket, threading, itertools, errno
 from multiprocessing import Process, Queue
 from queue import Empty as QueueEmpty
 # Custom modules
-from ModuleServer import utils, loggingProc, worker
+from ModuleServer import utils, loggingProc, worker, recorder
 
 help_text = \
 '''_help can be called as "name" in the server hello for available modules. \
@@ -21,6 +21,19 @@ If no module is specified, the server will force the config file to be reloaded
 This syntax is to circumvent the lack of args in the server hello. Responds with the action \
 taken by the server.
 
+_profile_{URLENCODED_MODULE_NAME} turns on cProfile in that module's worker (without restarting it). \
+Optional fields in the same hello: "requests" (profile this many requests), "seconds" (profile \
+for this long), "every" (only profile 1 in every N requests; default 1) and "path" (a file name in \
+the server's profile_dir; refused if the server has none). If neither \
+"requests" nor "seconds" is given, 100 requests are profiled. The worker replies once done with \
+{"requests","seconds","phases","stats"}: "phases" is the total and mean time spent in recv \
+(from the request's first byte), decode, dispatch, encode and send, and "stats" is the pstats text \
+(sorted by cumulative time; covers the request from once it has arrived). \
+If "path" is given, the worker replies immediately and the stats are dumped to "path" (pstats \
+format) when done, with the phases in the server log.
+
+_stats returns a dictionary of per-module health from worker heartbeats (last progress marker, seconds since last heartbeat, whether it is stalled, number of stalls/restarts and worker counters).
+
 Workers and server will send responses that are urlencoded(plus) json strings:
   {"response":RESPONSE,"error":ERROR_STATUS,"traceback":traceback.format_exc()}
      Where ERROR_STATUS is True/False and RESPONSE is from requested MODULE
@@ -29,8 +42,15 @@ All communication strings terminated by '\\n'
 
 Client is expected to send urlencoded(plus) json strings with fields:
   Server hello:
-  {"name":<name as str>}
+  {"name":<name as str>,"compress":[<codec as str>,...],"typed":<True/False>}
      Server will send ack if successfully passed to worker queue
+     "compress" is optional; it lists codecs the client accepts in order of preference.
+     Worker responses larger than utils.COMPRESS_THRESHOLD are then sent using the first
+     supported codec as "<codec>:<base64 of compressed json>" (no urlencoding) instead.
+     "typed" is optional (default False). Values json can't serialize (e.g. numpy arrays)
+     are sent with the encoders in utils.ENCODERS: as plain json (e.g. nested lists) by
+     default, or if True as tagged objects, e.g. numeric numpy arrays as
+     {"__ndarray__":<base64 of raw bytes>,"dtype":<numpy dtype str>,"shape":[...]}
   Then the request for the worker:
   {
      "function":<function in "name" as str>,
@@ -51,11 +71,13 @@ Client is expected to send urlencoded(plus) json strings with fields:
 ##   the client IP then the function name. The remaining args are piped in from
 ##   client request as ordered args (e.g. *args)
 ##   If no dispatch method specified, function is called diretly with just *args
+##   An optional 4th entry is a dictionary of options overriding DEFAULT_OPTIONS
 ##
 
 ## General approach for procs:
 ## Logging is handled by a separate process with one shared queue
-## Main for loop will monitor:
+## Recording (opt-in) is handled the same way (see recorder.py)
+## Maintenance thread will monitor (every SERVER_WAIT_TIMEOUT):
 ##   - the config file
 ##       - If changed, will reload config file and modify workers only if needed
 ##       - Poorly configured entries are ignored
@@ -66,10 +88,17 @@ Client is expected to send urlencoded(plus) json strings with fields:
 ##              then it is expected, and requires modifying the server config file
 ## Upon spawning:
 ##   - Each worker gets its own queue and the logging queue
+##   - Clients are put on the queue as (connection,addr,session) where session holds
+##       what was negotiated in the server hello (e.g. compression codec, typed)
 ##   - After spawning, a worker will reply True/False if successfully loaded the module (not the instance)
 ##   - If no response after a period of time, this main process will kill the worker
 ##       - The next time an attempt at spawning will be upon modification of config file
+##   - Modules with the lazy option are not spawned until the first client asks for them
+##       (the hello waits for the load), and are unloaded again after idle_timeout seconds unused
 ## Workers:
+##   - They send heartbeats and per-request progress markers on the shared status queue
+##   - If no heartbeat arrives within the module's stall_timeout (opt-in), the worker is considered stalled:
+##       queued clients get an error, new clients are refused and, if restart_on_stall, it is restarted
 ##   - They will handle the rest of the client request, and all communication to the client
 ##   - If the hardware module changes, they will reload the module and instance
 ##   - If None type received instead of client, signal to terminate
@@ -82,13 +111,43 @@ Client is expected to send urlencoded(plus) json strings with fields:
 ##   - If queue full, appropriate error is sent to client trying to connect
 ##   - Server will pong a ping without sending to worker (immediately closing connection after)
 #3   - Server will send help text and reload specified modules
+## Acceptors:
+##   - The main thread always accepts clients; a separate maintenance thread reloads config/checks
+##       modules so slow worker loads don't hold up accepting
+##   - Additional acceptor threads can be requested; they all accept on the main socket, so a
+##       connection is taken by whichever acceptor is free (SO_REUSEPORT is not used: it would tie
+##       each connection to one socket whether or not its thread is busy)
+##   - All acceptors share MODULES; any access to it is done holding MODULES_LOCK, but slow work
+##       (spawning/joining workers) is not: the module is marked as loading instead (see _begin_load)
+##       and handshakes for it wait for that to finish. Config reloads/checks hold MAINTENANCE_LOCK
+##   - Optionally, an acceptor thread also listens on a unix domain socket for local clients
+##       (same protocol; the client address is reported as ('localhost',socket path))
 
 LOGLEVEL = None
 CONFIG_PATH = None
 LOG_QUEUE = None
+STATUS_QUEUE = None # Shared by workers to send heartbeats: (name,pid,marker,time,counters or None)
+RECORD_QUEUE = None # Shared with workers to record traffic (None if not recording)
+PROFILE_DIR = None # Directory _profile_ may write stats to (None to refuse "path")
+SESSION_IDS = itertools.count() # Ties worker requests to server hello in recordings
 logger = None # setup in main()
 SERVER_WAIT_TIMEOUT = 0.5 # Period before checking modules
 MODULES = {} # {module_name:(config,(process_handle,queue))} (set in reload_config)
+MODULES_LOCK = threading.RLock() # Guards MODULES between acceptor threads
+LOADING = {} # {module_name:threading.Event} set once module is no longer being (re)loaded
+MAINTENANCE_LOCK = threading.RLock() # Only one thread reloads config/checks modules at a time
+STATS = {} # {module_name:{pid,marker,last_beat,stalled,counters,...counts}} (see _reset_stats)
+DEFAULT_OPTIONS = {
+    'stall_timeout':None, # Seconds without a heartbeat before worker is stalled (None to disable)
+    'restart_on_stall':False,
+    'lazy':False, # Spawn worker on first client instead of on config load
+    'idle_timeout':None, # Seconds unused before a lazy worker is unloaded (None to keep)
+}
+SHUTDOWN = threading.Event() # Signals acceptor threads to return
+# Listening/connection socket tuning (see main for args)
+LISTEN_BACKLOG = 128
+TCP_NODELAY = True
+TCP_KEEPALIVE = None # None to leave OS default, else (idle,interval,count) in seconds/probes
 
 def clean_config(configFile):
     # Remove names beginning with underscore (e.g. comments/examples)
@@ -101,13 +160,43 @@ def clean_config(configFile):
             configFile.pop(name)
             logging.warning('Removing "%s" from config. The config value should be list'%name)
             continue
-        if len(config) != 3:
+        if len(config) not in (3,4):
             configFile.pop(name)
             logging.warning('Removing "%s" from config. The config value should have 3 entries (found %i)'%(name,len(config)))
+            continue
+        if len(config) == 4 and type(config[3]) != dict:
+            configFile.pop(name)
+            logging.warning('Removing "%s" from config. The optional 4th entry should be a dictionary of options'%name)
+
+def module_options(config):
+    options = dict(DEFAULT_OPTIONS)
+    if len(config) == 4:
+        options.update(config[3])
+    return options
 
+def _begin_load(name):
+    # Mark name as being (re)loaded, waiting for anyone else loading it first
+    # Returns its current (config,(proc,q)) or None; call _end_load when done
+    while True:
+        with MODULES_LOCK:
+            loading = LOADING.get(name)
+            if loading is None:
+                LOADING[name] = threading.Event()
+                return MODULES.get(name)
+        loading.wait()
+
+def _end_load(name,entry):
+    # Publish entry as name's (config,(proc,q)) (None to remove name) and wake waiters
+    with MODULES_LOCK:
+        if entry is None:
+            MODULES.pop(name,None)
+        else:
+            MODULES[name] = entry
+        LOADING.pop(name).set()
 
 def reload_config(modules,path):
     # Dictionary passed by pointer, so modify directly
+    # Call holding MAINTENANCE_LOCK (not MODULES_LOCK; see _begin_load)
     logging.info('Reloading config file')
     try:
         with open(path,'rb') as fid:
@@ -115,23 +204,140 @@ def reload_config(modules,path):
     except ValueError as err:
         raise ValueError('Failed to load config file (no modules changed): %s'%str(err))
     clean_config(configFile)
-    loaded_workers = list(modules)
+    with MODULES_LOCK:
+        loaded_workers = [name for name in modules if name not in configFile]
     for name,config in configFile.items():
-        if name in loaded_workers: loaded_workers.remove(name)
-        [old_config,old_props] = modules.get(name,[None]*2)
-        if old_config != config or old_config is None:
-            [proc,q] = load_module(name,config,old_props)
-            modules[name] = (config,(proc,q))
+        entry = _begin_load(name)
+        try:
+            [old_config,old_props] = entry or [None]*2
+            if old_config != config or old_config is None:
+                if module_options(config)['lazy']:
+                    [proc,q] = _unload_module(name,old_props) if old_props else (None,None)
+                    _reset_stats(name,None,'lazy')
+                else:
+                    [proc,q] = load_module(name,config,old_props)
+                entry = (config,(proc,q))
+        finally:
+            _end_load(name,entry)
     # Clean up any workers not found in new config file
-    [_unload_module(name,modules[name][1]) for name in loaded_workers]
-    [modules.pop(name) for name in loaded_workers]
+    for name in loaded_workers:
+        entry = _begin_load(name)
+        try:
+            if entry:
+                _unload_module(name,entry[1])
+        finally:
+            _end_load(name,None)
 
 def check_modules(modules):
-    for name,props in modules.items():
-        [config,[proc,q]] = props
-        if proc and not proc.is_alive():
-            logging.critical('%s died, relaunching'%name)
-            modules[name] = (config,load_module(name,*props))
+    # Call holding MAINTENANCE_LOCK (not MODULES_LOCK; see _begin_load)
+    with MODULES_LOCK:
+        update_stats(modules)
+        names = list(modules)
+    for name in names:
+        entry = _begin_load(name)
+        try:
+            if entry is None: # Removed meanwhile
+                continue
+            [config,[proc,q]] = entry
+            if proc and not proc.is_alive():
+                logging.critical('%s died, relaunching'%name)
+                entry = (config,load_module(name,config,(proc,q)))
+            elif proc:
+                entry = check_stalled(name,entry)
+                entry = check_idle(name,entry)
+        finally:
+            _end_load(name,entry)
+
+def _reset_stats(name,pid,marker):
+    # Counts are kept across relaunches of a module
+    with MODULES_LOCK:
+        stats = STATS.setdefault(name,{'stalls':0,'restarts':0,'spawns':0,'evictions':0,
+                                       'spawn_time':None,'last_used':None,
+                                       'restart_streak':0,'last_restart':None})
+        stats.update(pid=pid,marker=marker,last_beat=time.time(),stalled=False,counters={})
+
+def update_stats(modules):
+    # Drain heartbeats from workers; ignore beats from procs no longer in use
+    while True:
+        try:
+            [name,pid,marker,t,counters] = STATUS_QUEUE.get_nowait()
+        except QueueEmpty:
+            break
+        proc = modules.get(name,[None,[None]])[1][0]
+        if proc is None or proc.pid != pid:
+            continue
+        stats = STATS[name]
+        stats.update(marker=marker,last_beat=t)
+        if counters is not None:
+            stats['counters'] = counters
+        if marker == 'idle':
+            stats['restart_streak'] = 0 # Worker got back to serving clients
+        if stats['stalled']:
+            logger.warning('%s worker recovered (%s)'%(name,marker))
+            stats['stalled'] = False
+
+def check_stalled(name,entry):
+    # Returns entry (config,(proc,q)) to use from now on
+    [config,[proc,q]] = entry
+    options = module_options(config)
+    stats = STATS[name]
+    age = time.time() - stats['last_beat']
+    if options['stall_timeout'] is None or age < options['stall_timeout']:
+        return entry
+    if stats['marker'] in ('load','reload'): # Constructing the module can take any amount of time
+        return entry
+    if not stats['stalled']:
+        logger.critical('%s worker stalled (no heartbeat for %.1f s; last marker: %s)'%(name,age,stats['marker']))
+        stats['stalled'] = True
+        stats['stalls'] += 1
+    # Let anyone waiting in the queue know now rather than timing out
+    _fail_queued(name,q,'%s worker is stalled (%s)'%(name,stats['marker']))
+    # Back off (doubling up to 64x stall_timeout) while restarted workers stall before getting idle
+    backoff = options['stall_timeout']*(2**min(stats['restart_streak'],6) - 1)
+    if options['restart_on_stall'] and time.time() - (stats['last_restart'] or 0) >= backoff:
+        logger.critical('Restarting %s'%name)
+        proc.terminate()
+        proc.join()
+        entry = (config,load_module(name,config,(None,q)))
+        STATS[name]['restarts'] += 1
+        STATS[name]['restart_streak'] += 1
+        STATS[name]['last_restart'] = time.time()
+    return entry
+
+def check_idle(name,entry):
+    # Unload lazy workers that have not been used in idle_timeout (and are not busy)
+    # Returns entry (config,(proc,q)) to use from now on
+    [config,[proc,q]] = entry
+    options = module_options(config)
+    stats = STATS[name]
+    if not proc or not options['lazy'] or options['idle_timeout'] is None or stats['stalled']:
+        return entry
+    if stats['marker'] != 'idle' or not q.empty():
+        return entry
+    if time.time() - (stats['last_used'] or stats['last_beat']) < options['idle_timeout']:
+        return entry
+    logger.info('%s idle for over %g s'%(name,options['idle_timeout']))
+    entry = (config,_unload_module(name,(proc,q)))
+    _reset_stats(name,None,'lazy')
+    stats['evictions'] += 1
+    return entry
+
+def _fail_queued(name,q,reason):
+    # Send error to all clients waiting in q and close them
+    while True:
+        try:
+            item = q.get_nowait()
+        except QueueEmpty:
+            break
+        if not isinstance(item,tuple): # Not a client (e.g. a stale load flag)
+            continue
+        [connection,addr,session] = item
+        try:
+            utils.send(connection,reason,error=Exception(reason))
+        except:
+            logger.exception('Could not send error to client %s'%addr[0])
+        finally:
+            connection.close()
 
 def _unload_module(name,old_module):
     # name: module name for logging
@@ -164,11 +370,15 @@ def load_module(name,config,old_module):
     if not q:
         logger.debug('Making new queue for %s'%name)
         q = Queue()
-    proc = Process(target=worker.main,args=(name,config,q,LOG_QUEUE,LOGLEVEL),name=name)
+    tstart = time.time()
+    proc = Process(target=worker.main,args=(name,config,q,LOG_QUEUE,LOGLEVEL,STATUS_QUEUE,RECORD_QUEUE,PROFILE_DIR),name=name)
     proc.start()
+    _reset_stats(name,proc.pid,'load')
+    STATS[name]['spawns'] += 1
     # Check success of module load in worker
     try:
         success = q.get(timeout=5)
+        STATS[name]['spawn_time'] = time.time() - tstart
         if not success:
             proc = None
     except QueueEmpty:
@@ -178,15 +388,161 @@ def load_module(name,config,old_module):
         proc = None
     return (proc,q)
 
-def launchServer(addr,port):
+def launchServer(addr,port,backlog=LISTEN_BACKLOG):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.settimeout(SERVER_WAIT_TIMEOUT)
     server_address=(addr,port)
     sock.bind(server_address)
     logger.critical('starting up on %s port %s'%server_address)
-    sock.listen(5)
+    sock.listen(backlog)
+    return sock
+
+def launchUnixServer(path,backlog=LISTEN_BACKLOG):
+    if not hasattr(socket,'AF_UNIX'):
+        raise OSError('Unix domain sockets are not supported on this platform')
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise OSError('"%s" exists and is not a socket'%path)
+        # Only remove it if left over from a previous run (nothing listening)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+        else:
+            raise OSError(errno.EADDRINUSE,'Address already in use: "%s"'%path)
+        finally:
+            probe.close()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(SERVER_WAIT_TIMEOUT)
+    sock.bind(path)
+    logger.critical('starting up on %s'%path)
+    sock.listen(backlog)
     return sock
 
+def launchAcceptors(addr,port,acceptors=1,backlog=LISTEN_BACKLOG):
+    # Returns list of listening sockets (one per acceptor thread); threads share one socket
+    return [launchServer(addr,port,backlog)]*acceptors
+
+def tune_connection(connection):
+    # Apply TCP_NODELAY and keepalive settings to an accepted connection
+    if connection.family != socket.AF_INET: # e.g. unix domain socket
+        return
+    if TCP_NODELAY:
+        connection.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    if TCP_KEEPALIVE:
+        connection.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+        for opt,val in zip(('TCP_KEEPIDLE','TCP_KEEPINTVL','TCP_KEEPCNT'),TCP_KEEPALIVE):
+            if hasattr(socket,opt): # Not all platforms expose these
+                connection.setsockopt(socket.IPPROTO_TCP,getattr(socket,opt),val)
+
+def acceptor(sock):
+    # Loop for additional acceptor threads (the main thread accepts in main())
+    client_addr = (None,None)
+    while not SHUTDOWN.is_set():
+        try:
+            connection, client_addr = sock.accept()
+        except IOError: # Timeout (or socket closed on shutdown)
+            continue
+        if sock.family != socket.AF_INET:
+            client_addr = ('localhost',sock.getsockname())
+        try:
+            connection.setblocking(0)
+            tune_connection(connection)
+            logger.debug('New Client: %s'%(client_addr[0]))
+            handleClient(connection,client_addr)
+        except:
+            logger.critical('Unhandled error in acceptor (client: %s)'%client_addr[0],exc_info=True)
+        finally:
+            # Don't keep the client's socket open here (or in workers forked meanwhile), so it
+            # closes when the worker handling it does (e.g. killed for stalling)
+            connection = None
+
+def maintenance():
+    # Loop for the maintenance thread; checks at least every SERVER_WAIT_TIMEOUT
+    while not SHUTDOWN.is_set():
+        tstart = time.time()
+        try:
+            with MAINTENANCE_LOCK:
+                # Check config file for changes
+                if utils.modified(CONFIG_PATH):
+                    try:
+                        reload_config(MODULES,CONFIG_PATH)
+                    except:
+                        logger.exception('Failed to reload config')
+                # Check to make sure workers are still running
+                check_modules(MODULES)
+        except:
+            logger.critical('Unhandled error in maintenance',exc_info=True)
+        SHUTDOWN.wait(max(0,SERVER_WAIT_TIMEOUT - (time.time() - tstart)))
+
+def _check_worker(name,proc,q):
+    # Returns q if name's worker can take clients; call holding MODULES_LOCK
+    STATS[name]['last_used'] = time.time()
+    if proc and STATS[name]['stalled']:
+        raise Exception('%s worker is stalled (%s)'%(name,STATS[name]['marker']))
+    elif not (proc and proc.is_alive()):
+        raise Exception('%s worker is not alive!'%name)
+    return q
+
+def _worker_queue(name):
+    # Returns the queue of name's running worker, spawning it first if lazy
+    # If name is being (re)loaded, waits for that rather than failing (call without MODULES_LOCK)
+    while True:
+        with MODULES_LOCK:
+            loading = LOADING.get(name)
+            if loading is None:
+                if name not in MODULES:
+                    raise utils.BadRequest('%s does not exist (case matters)'%name)
+                entry = MODULES[name]
+                [config,[proc,q]] = entry
+                if not (proc is None and module_options(config)['lazy']):
+                    return _check_worker(name,proc,q)
+                LOADING[name] = threading.Event() # Other handshakes for name wait on this
+                break
+        loading.wait()
+    # Lazy spawn without MODULES_LOCK so handshakes for other modules carry on meanwhile
+    try:
+        entry = (config,load_module(name,config,(proc,q)))
+    finally:
+        _end_load(name,entry)
+    with MODULES_LOCK:
+        return _check_worker(name,*entry[1])
+
+def _needs_load(name):
+    # True if a handshake for name would have to wait for its worker to (lazily) load
+    with MODULES_LOCK:
+        if name in LOADING:
+            return True
+        if name not in MODULES:
+            return False
+        [config,[proc,q]] = MODULES[name]
+        return proc is None and module_options(config)['lazy']
+
+def _queue_client(connection,addr,name,msg,profile=None):
+    # Put the client on name's worker queue, acking the server hello
+    # profile: None or options of a _profile_ request (no ack; the worker replies with the profile)
+    try:
+        q = _worker_queue(name)
+        session = {'codec':utils.negotiate(msg.get('compress')),'typed':bool(msg.get('typed')),
+                   'id':'%x.%i'%(os.getpid(),next(SESSION_IDS))}
+        if profile is None:
+            recorder.record(RECORD_QUEUE,k='hello',id=session['id'],ip=addr[0],
+                            name=name,compress=msg.get('compress'),typed=session['typed'])
+            utils.send(connection,'ack')
+        else:
+            session['profile'] = profile
+        q.put((connection,addr,session))
+    except KeyboardInterrupt: # Shutting down (main thread); don't treat as client error
+        raise
+    except:
+        try:
+            utils.send(connection,error=True)
+        except:
+            logger.exception('Could not send error to client')
+        connection.close()
+        logger.exception('Client %s handle failed'%addr[0])
+
 def handleClient(connection,addr):
     # Expects first transmission to be urlencoded json string
     # No finally block here, because upon getting on queue, dont close!
@@ -196,37 +552,58 @@ def handleClient(connection,addr):
             utils.send(connection,addr)
             connection.close()
         elif msg['name'] == '_help':
-            resp = 'Available modules: %s\n\n%s'%(', '.join(MODULES),help_text)
+            with MODULES_LOCK:
+                resp = 'Available modules: %s\n\n%s'%(', '.join(MODULES),help_text)
             utils.send(connection,resp)
             connection.close()
         elif msg['name'][0:12] == '_get_modules':
             match = msg['name'][13:]
-            resp = [mod for mod in MODULES.keys() if mod[0:len(match)]==match]
+            with MODULES_LOCK:
+                resp = [mod for mod in MODULES.keys() if mod[0:len(match)]==match]
+            utils.send(connection,resp)
+            connection.close()
+        elif msg['name'] == '_stats':
+            now = time.time()
+            with MODULES_LOCK:
+                resp = {name:dict(STATS[name],age=now-STATS[name]['last_beat'],
+                                  running=bool(MODULES[name][1][0] and MODULES[name][1][0].is_alive()))
+                            for name in MODULES if name in STATS}
             utils.send(connection,resp)
             connection.close()
         elif msg['name'][0:8] == '_reload_':
             module_to_reload = utils.urllib.unquote_plus(msg['name'][8:])
-            if not module_to_reload:
-                resp = 'Reloaded config'
-                reload_config(MODULES,CONFIG_PATH)
-            elif module_to_reload in MODULES:
-                resp = 'Reloaded "%s"'%module_to_reload
-                _unload_module(module_to_reload,MODULES[module_to_reload][1])
-                MODULES.pop(module_to_reload)
-                reload_config(MODULES,CONFIG_PATH)
-            else:
-                resp = 'Failed to find module "%s"'%module_to_reload
+            with MAINTENANCE_LOCK:
+                with MODULES_LOCK:
+                    found = module_to_reload in MODULES
+                if not module_to_reload:
+                    resp = 'Reloaded config'
+                    reload_config(MODULES,CONFIG_PATH)
+                elif found:
+                    resp = 'Reloaded "%s"'%module_to_reload
+                    entry = _begin_load(module_to_reload)
+                    try:
+                        if entry:
+                            _unload_module(module_to_reload,entry[1])
+                    finally:
+                        _end_load(module_to_reload,None)
+                    reload_config(MODULES,CONFIG_PATH)
+                else:
+                    resp = 'Failed to find module "%s"'%module_to_reload
             utils.send(connection,resp)
             connection.close()
         else:
-            if msg['name'] in MODULES:
-                if MODULES[msg['name']][1][0].is_alive():
-                    utils.send(connection,'ack')
-                    MODULES[msg['name']][1][1].put((connection,addr))
-                else:
-                    raise Exception('%s worker is not alive!'%msg['name'])
+            [name,profile] = [msg['name'],None]
+            if name[0:9] == '_profile_':
+                # The worker replies with the profile (or immediately if writing to path)
+                name = utils.urllib.unquote_plus(name[9:])
+                profile = {field:msg.get(field) for field in ('requests','seconds','every','path')}
+            if _needs_load(name):
+                # Don't hold up this acceptor while the module loads
+                threading.Thread(target=_queue_client,args=(connection,addr,name,msg,profile),daemon=True).start()
             else:
-                raise utils.BadRequest('%s does not exist (case matters)'%msg['name'])
+                _queue_client(connection,addr,name,msg,profile)
+    except KeyboardInterrupt: # Shutting down (main thread); don't treat as client error
+        raise
     except:
         try:
             utils.send(connection,error=True)
@@ -236,39 +613,69 @@ def handleClient(connection,addr):
         logger.exception('Client %s handle failed'%addr[0])
     logger.debug('Finished handling client')
 
-def main(server_name,config_path,server_addr='localhost',server_port=36577,loglevel=logging.DEBUG,logfile=None):
-    global LOGLEVEL, LOG_QUEUE, CONFIG_PATH, logger
+def main(server_name,config_path,server_addr='localhost',server_port=36577,loglevel=logging.DEBUG,logfile=None,
+         acceptors=1,backlog=LISTEN_BACKLOG,nodelay=TCP_NODELAY,keepalive=TCP_KEEPALIVE,record=None,
+         unix_path=None,profile_dir=None):
+    # acceptors: number of threads accepting clients (including main thread)
+    # backlog: listen backlog for each listening socket
+    # nodelay: set TCP_NODELAY on client connections
+    # keepalive: None or (idle,interval,count) to enable TCP keepalive on client connections
+    # record: None or path of file to append recorded traffic to (see recorder.py)
+    # unix_path: None or path to also listen on as a unix domain socket
+    # profile_dir: None or directory clients may have _profile_ stats written to (by file name)
+    global LOGLEVEL, LOG_QUEUE, STATUS_QUEUE, RECORD_QUEUE, CONFIG_PATH, TCP_NODELAY, TCP_KEEPALIVE, PROFILE_DIR, logger
     LOGLEVEL = loglevel
     CONFIG_PATH = config_path
+    TCP_NODELAY = nodelay
+    TCP_KEEPALIVE = keepalive
+    PROFILE_DIR = profile_dir
     os.system("title "+"%s (%s:%i)"%(server_name,server_addr,server_port))
     # Setup logging thread
     LOG_QUEUE = Queue()
+    STATUS_QUEUE = Queue()
     log_proc = Process(target=loggingProc.listener_process,args=(LOG_QUEUE,logfile),name='logging')
     log_proc.start()
+    if record:
+        RECORD_QUEUE = Queue()
+        record_proc = Process(target=recorder.listener_process,args=(RECORD_QUEUE,record),name='recorder')
+        record_proc.start()
     # Setup logging for main
     h = loggingProc.QueueHandler(LOG_QUEUE)
     logger = logging.getLogger()
     logger.addHandler(h)
     logger.setLevel(LOGLEVEL)
-    sock = launchServer(server_addr,server_port)
+    try:
+        socks = launchAcceptors(server_addr,server_port,acceptors,backlog)
+        if unix_path:
+            socks.append(launchUnixServer(unix_path,backlog))
+    except:
+        # e.g. address in use; stop helper processes so this process can exit
+        logger.critical('Failed to start listening',exc_info=True)
+        if RECORD_QUEUE:
+            RECORD_QUEUE.put_nowait(None)
+            record_proc.join()
+        LOG_QUEUE.put_nowait(None)
+        log_proc.join()
+        raise
+    sock = socks[0]
+    threads = [threading.Thread(target=acceptor,args=(s,),name='acceptor%i'%i,daemon=True)
+                    for i,s in enumerate(socks[1:],1)]
+    threads.append(threading.Thread(target=maintenance,name='maintenance',daemon=True))
     client_addr = (None,None)
     try:
+        [t.start() for t in threads]
         while True:
             try: # Main try block
                 try:
                     connection, client_addr = sock.accept()
                     connection.setblocking(0)
+                    tune_connection(connection)
                     logger.debug('New Client: %s'%(client_addr[0]))
                     handleClient(connection,client_addr)
                 except IOError: # Most likely timeout error (every second)
-                    # Check config file for changes
-                    if utils.modified(CONFIG_PATH):
-                        try:
-                            reload_config(MODULES,CONFIG_PATH)
-                        except:
-                            logger.exception('Failed to reload config')
-                    # Check to make sure workers are still running
-                    check_modules(MODULES)
+                    pass
+                finally:
+                    connection = None # See acceptor
             except KeyboardInterrupt:
                 raise
             except:
@@ -276,11 +683,18 @@ def main(server_name,config_path,server_addr='localhost',server_port=36577,logle
     except (KeyboardInterrupt,SystemExit):
         logger.critical('Shutting down')
     finally:
-        sock.close() # No more connections
+        SHUTDOWN.set()
+        [s.close() for s in set(socks)] # No more connections
+        [t.join() for t in threads]
+        if unix_path and os.path.exists(unix_path):
+            os.remove(unix_path)
         try:
             for name,props in MODULES.items():
                 _unload_module(name,props[1])
         finally:
+            if RECORD_QUEUE:
+                RECORD_QUEUE.put_nowait(None)
+                record_proc.join()
             LOG_QUEUE.put_nowait(None)
             log_proc.join()
 
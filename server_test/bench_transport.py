@@ -0,0 +1,47 @@
+import sys, os, time, signal, logging
+from multiprocessing import Process
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_PATH,'..')) # For server_test modules in config
+from ModuleServer import server
+from ModuleServer.client import client
+
+# Compare latency of loopback TCP and unix domain socket transports on this machine.
+# Starts a server with the server_test config and times sequential calls over each:
+#   python -m ModuleServer.server_test.bench_transport [calls]
+
+CONFIG_PATH = os.path.join(BASE_PATH,'server.config')
+PORT = 36578
+UNIX_PATH = os.path.join(BASE_PATH,'bench.sock')
+
+def bench(fn,calls):
+    times = []
+    for i in range(calls):
+        tstart = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - tstart)
+    times.sort()
+    return sum(times)/calls, times[calls//2], times[int(calls*0.99)]
+
+if __name__ == '__main__':
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    proc = Process(target=server.main,args=('bench',CONFIG_PATH,'localhost',PORT,logging.WARNING),
+                   kwargs={'unix_path':UNIX_PATH})
+    proc.start()
+    try:
+        clients = [('tcp',client(port=PORT)),('unix',client(unix_path=UNIX_PATH))]
+        tstart = time.time()
+        while True: # Wait for server and modules to load
+            try:
+                if 'mod2' in clients[0][1].get_modules():
+                    break
+            except Exception:
+                if time.time() - tstart > 20: raise
+            time.sleep(0.5)
+        print('%-6s %-8s %10s %10s %10s'%('','','mean (us)','p50 (us)','p99 (us)'))
+        for name,c in clients:
+            for label,fn in (('ping',c.ping),('com',lambda: c.com('mod2','my_fun'))):
+                fn() # Warm up
+                print('%-6s %-8s %10.1f %10.1f %10.1f'%((name,label)+tuple(t*1e6 for t in bench(fn,calls))))
+    finally:
+        os.kill(proc.pid,signal.SIGINT) # Shutdown nicely so workers are unloaded
+        proc.join()
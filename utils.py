@@ -1,8 +1,74 @@
-import os, time, json, sys, traceback, socket
+import os, time, json, sys, traceback, socket, select, errno, zlib, base64
 if sys.version_info[0] > 2:
     import urllib.parse as urllib
 else:
     import urllib
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Response compression (negotiated per connection in the server hello)
+# A compressed message is sent as "<codec>:<base64 of compressed json>" instead of
+# urlencoded json (which never contains a bare ':'), then the usual delim
+COMPRESS_THRESHOLD = 4096 # Bytes of json below which responses are sent uncompressed
+COMPRESS_CHUNK = 3*2**16 # Bytes fed to compressor at a time (multiple of 3 to base64 in pieces)
+SEND_STATS = {'raw_bytes':0,'wire_bytes':0,'compressed':0} # Counters for send in this process
+
+class _LZ4Compressor:
+    # Give lz4's frame compressor the same interface as zlib.compressobj
+    def __init__(self):
+        self._compressor = lz4.frame.LZ4FrameCompressor()
+        self._header = self._compressor.begin()
+    def compress(self,data):
+        data = self._header + self._compressor.compress(data)
+        self._header = b''
+        return data
+    def flush(self):
+        return self._header + self._compressor.flush()
+
+CODECS = {'zlib':(zlib.compressobj,zlib.decompressobj)} # {name:(compressor factory,decompressor factory)}
+if lz4:
+    CODECS['lz4'] = (_LZ4Compressor,lz4.frame.LZ4FrameDecompressor)
+
+# Encoding of values json can't serialize (e.g. numpy arrays), see register_encoder
+# Every encoder has a plain form (e.g. nested lists) that any client can read. Clients that
+# set "typed" in the server hello get the tagged form instead if there is one: a json object
+# {"__<tag>__":...} that client.py's decoders turn back into the original type
+ENCODERS = [] # [(types,plain fn,tag,tagged fn)] first match wins
+
+def register_encoder(types,plain,tag=None,tagged=None):
+    # types -> type or tuple of types (subclasses included)
+    # plain -> fn(value) returning something json can serialize
+    # tag/tagged -> name and fn(value) returning {"__<tag>__":...} for typed clients
+    # Modules can call this to send their own types (it applies in their worker)
+    ENCODERS.insert(0,(types,plain,tag,tagged))
+
+class Encoder(json.JSONEncoder):
+    # Only called for values json can't serialize itself, so plain json pays nothing
+    def __init__(self,typed=False,**kwargs):
+        super().__init__(**kwargs)
+        self.typed = typed
+    def default(self,obj):
+        for types,plain,tag,tagged in ENCODERS:
+            if isinstance(obj,types):
+                return tagged(obj) if self.typed and tagged else plain(obj)
+        return super().default(obj)
+
+register_encoder(complex,lambda z:[z.real,z.imag],'complex',lambda z:{'__complex__':[z.real,z.imag]})
+if numpy:
+    def _ndarray_tagged(arr):
+        # Raw bytes of numeric arrays; anything else (e.g. strings, objects) as lists
+        if arr.dtype.kind not in 'biufc': return arr.tolist()
+        return {'__ndarray__':base64.b64encode(numpy.ascontiguousarray(arr).data).decode('ascii'),
+                'dtype':arr.dtype.str,'shape':arr.shape}
+    # tolist converts all elements in C (complex elements then use the complex encoder)
+    register_encoder(numpy.ndarray,lambda arr:arr.tolist(),'ndarray',_ndarray_tagged)
+    register_encoder(numpy.generic,lambda x:x.item()) # numpy scalars (e.g. numpy.int64)
 
 class timeout(IOError):
     pass
@@ -28,36 +94,89 @@ def modified(path):
     return changed
 modified.last = {} # Initialize
 
-def recv(connection,delim=b'\n',recv_buffer=4096,time_out=1,validate_exists=[]):
+def negotiate(offered):
+    # Choose first codec offered by client that we support (None if no compression)
+    for codec in offered or []:
+        if codec in CODECS:
+            return codec
+    return None
+
+def decompress(data):
+    # data: bytes of "<codec>:<base64>" (without delim)
+    [codec,_,data] = data.partition(b':')
+    decompressor = CODECS[codec.decode('utf-8')][1]()
+    chunk = 4*2**16 # Multiple of 4 to b64decode in pieces
+    return b''.join(decompressor.decompress(base64.b64decode(data[i:i+chunk]))
+                        for i in range(0,len(data),chunk)).decode('utf-8')
+
+def recv(connection,delim=b'\n',recv_buffer=4096,time_out=1,validate_exists=[],timings=None,compressed=False):
+    # timings -> None or dict to set "recv" (from first byte) and "decode" durations in
+    # compressed -> accept compressed messages (responses only; requests are always urlencoded)
     buffer = b''
     tstart = time.time()
+    tfirst = None # First byte received (time waiting for the peer to send isn't "recv")
     while time.time() - tstart < time_out:
         try:
             data = connection.recv(recv_buffer)
         except socket.timeout:
             raise
         except IOError as err:
-            if err.errno in [35, 10035]: # Resource temporarily unavailable, Timeout
-                time.sleep(0.01)
+            if err.errno in [errno.EAGAIN, errno.EWOULDBLOCK, 35, 10035]: # Resource temporarily unavailable, Timeout
+                # Wait until readable rather than polling (the loop checks time_out)
+                select.select([connection],[],[],max(0,time_out-(time.time()-tstart)))
                 continue
             raise
         if not data: raise IOError('Client disconnected while receiving.')
+        if tfirst is None:
+            tfirst = time.time()
         buffer += data
         if data[-1:] == delim:
-            msg = buffer[0:-len(delim)].decode('utf-8')  # Remove delim
+            tdecode = time.time()
+            msg = buffer[0:-len(delim)]  # Remove delim
             try:
-                msg = urllib.unquote_plus(msg)
+                if compressed and b':' in msg:
+                    msg = decompress(msg)
+                else:
+                    msg = urllib.unquote_plus(msg.decode('utf-8'))
                 msg = json.loads(msg)
             except Exception as err:
                 raise Exception('Failed to decode msg: "%s"'%(msg,))
             for field in validate_exists:
                 if field not in msg: raise BadRequest('"%s" field missing from request.'%field)
+            if timings is not None:
+                timings['recv'] = tdecode - tfirst
+                timings['decode'] = time.time() - tdecode
             return msg
     raise timeout('Did not receive all client data in timeout period (%g seconds). Make sure terminated with "\\n".\nPartial message: "%s"'% \
         (time_out,urllib.unquote_plus(buffer.decode('utf-8'))))
 
-def send(connection,resp='',delim=b'\n',error=False):
+def _send_compressed(connection,payload,codec,delim):
+    # Stream payload through compressor and base64 so only a chunk is held at a time
+    compressor = CODECS[codec][0]()
+    payload = memoryview(payload)
+    pending = b''
+    wire = codec.encode('utf-8')+b':'
+    connection.sendall(wire)
+    wire = len(wire)
+    for i in range(0,len(payload),COMPRESS_CHUNK):
+        pending += compressor.compress(payload[i:i+COMPRESS_CHUNK])
+        n = len(pending) - len(pending)%3
+        if n:
+            data = base64.b64encode(pending[:n])
+            connection.sendall(data)
+            wire += len(data)
+            pending = pending[n:]
+    data = base64.b64encode(pending+compressor.flush())+delim
+    connection.sendall(data)
+    return wire + len(data)
+
+def send(connection,resp='',delim=b'\n',error=False,codec=None,timings=None,typed=False):
     # error -> either True/False or an Exception object
+    # codec -> name in CODECS negotiated with client or None; only used above COMPRESS_THRESHOLD
+    # typed -> use tagged form of registered encoders (negotiated with client)
+    # timings -> None or dict to set "encode" and "send" durations in (compression counts as send)
+    # Returns (bytes of json,bytes sent) where they differ if compressed
+    tstart = time.time()
     tb_formatted = ''
     if error: # Anything but empty, 0, or False
         if error is True:  # Use current exception to print traceback
@@ -65,5 +184,20 @@ def send(connection,resp='',delim=b'\n',error=False):
         else:              # error is some Exception object, so use that
             exc = error
         tb_formatted = ''.join(traceback.format_exception(None,exc,exc.__traceback__))
-    resp = json.dumps({'response':resp,'error':bool(error),'traceback':tb_formatted})
-    connection.sendall(bytes(urllib.quote_plus(resp),'utf-8')+delim)
\ No newline at end of file
+    resp = json.dumps({'response':resp,'error':bool(error),'traceback':tb_formatted},cls=Encoder,typed=typed)
+    raw = len(resp)
+    SEND_STATS['raw_bytes'] += raw
+    if codec and len(resp) >= COMPRESS_THRESHOLD:
+        tsend = time.time()
+        wire = _send_compressed(connection,resp.encode('utf-8'),codec,delim)
+        SEND_STATS['compressed'] += 1
+    else:
+        resp = bytes(urllib.quote_plus(resp),'utf-8')+delim
+        tsend = time.time()
+        connection.sendall(resp)
+        wire = len(resp)
+    SEND_STATS['wire_bytes'] += wire
+    if timings is not None:
+        timings['encode'] = tsend - tstart
+        timings['send'] = time.time() - tsend
+    return raw, wire
\ No newline at end of file
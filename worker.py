@@ -1,7 +1,11 @@
-import os, logging, inspect
-import importlib
+import os, io, time, logging, inspect
+import importlib, cProfile, pstats
 import queue as Queue
-from . import loggingProc, utils
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+from . import loggingProc, utils, recorder
 
 # Currently can only handle 1 client
 # Currently does not use __enter__ methods for INSTANCE instance, but does use __exit__
@@ -14,6 +18,15 @@ MODULE = None # module imported
 # Purpose of setting to [] is to wait for change in file again
 # before attempting to reload the module
 INSTANCE = None
+STATUS_QUEUE = None # Heartbeats to server (None to disable)
+BEAT_INTERVAL = 0.5 # Minimum seconds between heartbeats unless forced
+LAST_BEAT = 0
+RECORD_QUEUE = None # Traffic recording (None to disable)
+COUNTERS = {'clients':0,'requests':0,'errors':0} # Sent with each heartbeat
+PROFILE = None # Active profile requested by _profile_ (see start_profile)
+PROFILE_PHASES = ('recv','decode','dispatch','encode','send')
+PROFILE_LINES = 40 # Lines of pstats text to reply with
+PROFILE_DIR = None # Directory "path" of a profile must be in (None to refuse paths)
 logger = None
 
 class NoINSTANCE(Exception):
@@ -21,34 +34,177 @@ class NoINSTANCE(Exception):
 class ModuleException(Exception):
     pass
 
+def beat(marker,force=False):
+    # Send heartbeat with progress marker to server (never blocks)
+    # Unless forced, skipped if within BEAT_INTERVAL of the last one so busy workers
+    # don't flood the queue; forced beats don't carry counters to keep them small
+    global LAST_BEAT
+    if STATUS_QUEUE is None: return
+    now = time.time()
+    if not force and now - LAST_BEAT < BEAT_INTERVAL: return
+    try:
+        counters = None
+        if not force:
+            counters = dict(COUNTERS,**utils.SEND_STATS)
+            if resource:
+                counters['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # kB on linux
+        STATUS_QUEUE.put_nowait((NAME,os.getpid(),marker,now,counters))
+        LAST_BEAT = now
+    except:
+        logger.debug('Failed to send heartbeat',exc_info=True)
+
+def record(session,msg,treceived,tdispatched,nbytes,error=False):
+    # nbytes: (json,wire) bytes returned by utils.send
+    if RECORD_QUEUE is None: return
+    recorder.record(RECORD_QUEUE,k='req',id=session['id'],t=treceived,f=msg['function'],a=msg['args'],
+                    ka=msg['keep_alive'],dt=tdispatched-treceived,rt=time.time()-treceived,
+                    b=nbytes[0],w=nbytes[1],e=error)
+
+def profile_path(path):
+    # Resolve file name requested by client in PROFILE_DIR; clients can't write anywhere else
+    if PROFILE_DIR is None:
+        raise utils.BadRequest('Server has no profile_dir to write stats to; omit "path"')
+    if not isinstance(path,str):
+        raise utils.BadRequest('path must be a string')
+    root = os.path.realpath(PROFILE_DIR)
+    full = os.path.realpath(os.path.join(root,path))
+    if os.path.dirname(full) != root:
+        raise utils.BadRequest('path must be a file name in the server\'s profile_dir')
+    return full
+
+def start_profile(client):
+    global PROFILE
+    [client,addr,session] = client
+    options = session['profile']
+    try:
+        if PROFILE: raise utils.BadRequest('%s is already being profiled'%NAME)
+        # Fields come straight from the client, so check them before they can break requests
+        for field,types in (('requests',(int,)),('every',(int,)),('seconds',(int,float))):
+            value = options[field]
+            if value is not None and (type(value) not in types or value <= 0):
+                raise utils.BadRequest('"%s" must be a positive %s'%(field,' or '.join(t.__name__ for t in types)))
+        if options['requests'] is None and options['seconds'] is None:
+            options['requests'] = 100
+        if options['path'] is not None:
+            options['path'] = profile_path(options['path'])
+            open(options['path'],'wb').close() # Fail now rather than when done
+        PROFILE = {'profiler':cProfile.Profile(),'requests':options['requests'],
+                   'until':time.time()+options['seconds'] if options['seconds'] else None,
+                   'every':options['every'] or 1,'seen':0,'count':0,'tstart':time.time(),
+                   'phases':{phase:0 for phase in PROFILE_PHASES},'path':options['path'],
+                   'client':client,'codec':session['codec']}
+        logger.info('Profiling %s (client: %s): %s'%(NAME,addr[0],options))
+        if options['path']:
+            utils.send(client,'Profiling; stats will be written to "%s"'%options['path'])
+            client.close()
+    except:
+        logger.exception('Failed to start profile (client: %s)'%addr[0])
+        utils.send(client,error=True)
+        client.close()
+
+def profile_begin(timings):
+    # Called once a request has arrived (so waiting on the client isn't profiled) with its
+    # recv/decode timings; returns them (and enables profiler) if sampled, else None
+    if not PROFILE: return None
+    PROFILE['seen'] += 1
+    if (PROFILE['seen']-1) % PROFILE['every']: return None
+    PROFILE['profiler'].enable()
+    return timings
+
+def profile_end(timings):
+    # Only requests that made it to dispatch count
+    # timings is None for requests that weren't sampled (the "seconds" limit still applies)
+    if timings is not None and PROFILE:
+        PROFILE['profiler'].disable()
+        if 'dispatch' in timings:
+            PROFILE['count'] += 1
+            for phase,t in timings.items():
+                PROFILE['phases'][phase] += t
+    check_profile()
+
+def check_profile():
+    if not PROFILE: return
+    if (PROFILE['requests'] is not None and PROFILE['count'] >= PROFILE['requests']) or \
+       (PROFILE['until'] is not None and time.time() >= PROFILE['until']):
+        finish_profile()
+
+def finish_profile():
+    global PROFILE
+    [profile,PROFILE] = [PROFILE,None]
+    n = profile['count']
+    phases = {phase:{'total':t,'mean':t/n if n else None} for phase,t in profile['phases'].items()}
+    if profile['path']:
+        try:
+            profile['profiler'].dump_stats(profile['path'])
+            logger.info('Profile of %s written to "%s" (%i requests): %s'%(NAME,profile['path'],n,phases))
+        except:
+            logger.exception('Failed to write profile of %s to "%s"'%(NAME,profile['path']))
+        return
+    stream = io.StringIO()
+    if n: # pstats errors if nothing was profiled
+        pstats.Stats(profile['profiler'],stream=stream).sort_stats('cumulative').print_stats(PROFILE_LINES)
+    resp = {'requests':n,'seconds':time.time()-profile['tstart'],'phases':phases,'stats':stream.getvalue()}
+    try:
+        utils.send(profile['client'],resp,codec=profile['codec'])
+    except:
+        logger.exception('Failed to send profile')
+    finally:
+        profile['client'].close()
+
 def handleClient(client):
-    [client,addr] = client
+    [client,addr,session] = client
+    codec = session['codec']
+    timings = None # Set if request is being profiled
+    msg = None # Last request received (to record failures)
+    COUNTERS['clients'] += 1
+    beat('client')
     try:
         while True:
-            msg = utils.recv(client,validate_exists=['keep_alive','function','args'])
+            msg = None
+            received = {} # recv/decode timings; kept if request is profiled
+            msg = utils.recv(client,validate_exists=['keep_alive','function','args'],timings=received)
+            treceived = time.time()
+            timings = profile_begin(received)
             # Validate fields
             if msg['keep_alive'] not in [True,False]: raise utils.BadRequest('keep_alive must be a boolean')
             if type(msg['args']) is not list: raise utils.BadRequest('args should be a list of values')
             # Dispatch
             logger.debug('Dispatching: '+str(msg))
             if not INSTANCE: raise NoINSTANCE('Module failed to load INSTANCE') # handle case for []
+            COUNTERS['requests'] += 1
+            beat('dispatch %s'%msg['function'],force=True) # Always know what a hung worker was doing
+            tdispatch = time.time()
             result = dispatch(client,addr,**msg)
-            utils.send(client,result)
+            tdispatched = time.time()
+            if timings is not None:
+                timings['dispatch'] = tdispatched - tdispatch
+            beat('send')
+            nbytes = utils.send(client,result,codec=codec,timings=timings,typed=session['typed'])
+            record(session,msg,treceived,tdispatched,nbytes)
+            profile_end(timings)
+            timings = None
             if not msg['keep_alive']:
                 break
     except ModuleException as exc:
+        COUNTERS['errors'] += 1
         if exc.__cause__:
             exc = exc.__cause__ # Unwrap ModuleException layer
         logger.exception('Error from module (client: %s)'%addr[0],exc_info=(type(exc),exc,exc.__traceback__))
-        utils.send(client,error=exc)
+        nbytes = utils.send(client,error=exc,codec=codec)
+        record(session,msg,treceived,time.time(),nbytes,error=True)
     except IOError:
         logger.exception('Client lost (client: %s)'%addr[0])
     except:
+        COUNTERS['errors'] += 1
         logger.exception('Unhandled error in worker\'s client loop (client: %s)'%addr[0])
-        utils.send(client,error=True)
+        nbytes = utils.send(client,error=True,codec=codec)
+        if msg is not None: # e.g. BadRequest or NoINSTANCE
+            record(session,msg,treceived,time.time(),nbytes,error=True)
     finally:
+        profile_end(timings)
         logger.debug('Closed client: %s'%addr[0])
         client.close()
+        beat('idle')
 
 def _help():
     help_text = ['Note, you can only supply positional arguments (not keyword arguments)']
@@ -84,10 +240,29 @@ def dispatch(client,addr,function,args,**kwargs):
         raise ModuleException() from err
     return result
 
-def main(name,config,queue,log_queue,loglevel):
-    global NAME, CONFIG, PATH, INSTANCE, MODULE, logger
+def reload_instance():
+    global INSTANCE
+    logger.info('Reloading module and instance')
+    beat('reload',force=True)
+    try:
+        INSTANCE.__exit__(None,None,None)
+        logger.debug('Exiting INSTANCE instance')
+    except:
+        logger.debug('INSTANCE instance has no __exit__')
+    INSTANCE = [] # Used to signify error state in dispatch
+    importlib.reload(MODULE)
+    INSTANCE = getattr(MODULE,CONFIG[1])()
+
+def main(name,config,queue,log_queue,loglevel,status_queue=None,record_queue=None,profile_dir=None):
+    global NAME, CONFIG, PATH, INSTANCE, MODULE, STATUS_QUEUE, RECORD_QUEUE, PROFILE_DIR, logger
     NAME = name
-    CONFIG = config # [module path, entry point, dispatch fn/None]
+    CONFIG = config # [module path, entry point, dispatch fn/None, (options)]
+    STATUS_QUEUE = status_queue
+    utils.SEND_STATS.update({key:0 for key in utils.SEND_STATS}) # Don't count what the server sent before fork
+    if STATUS_QUEUE is not None:
+        STATUS_QUEUE.cancel_join_thread() # Don't block exiting on heartbeats the server hasn't read
+    RECORD_QUEUE = record_queue
+    PROFILE_DIR = profile_dir
 
     # Setup logging
     h = loggingProc.QueueHandler(log_queue)
@@ -103,6 +278,7 @@ def main(name,config,queue,log_queue,loglevel):
         PATH = os.path.abspath(MODULE.__file__) # .pyc file
         PATH = os.path.splitext(PATH)[0] + '.py'
         assert os.path.isfile(PATH), 'Could not find \'%s\''%CONFIG[0]
+        utils.modified(PATH) # First call always True; INSTANCE is None triggers first load
     except:
         logger.critical('Failed to load module',exc_info=True)
         queue.put(False)
@@ -118,20 +294,21 @@ def main(name,config,queue,log_queue,loglevel):
                     if msg is None:
                         logger.debug('%s worker returning'%NAME)
                         break
-                    if INSTANCE is None: raise NoINSTANCE('INSTANCE does not exist yet')
+                    if msg[2].get('profile'):
+                        start_profile(msg)
+                        continue
+                    if INSTANCE is None: # Client arrived before first load (e.g. lazy spawn)
+                        try:
+                            reload_instance()
+                        except:
+                            logger.exception('Failed to load INSTANCE') # handleClient will reply with error
                     handleClient(msg)
-                except (Queue.Empty,NoINSTANCE):
+                except Queue.Empty:
                     # Effectively limit to on timeouts to not interfere
                     if utils.modified(PATH) or INSTANCE is None:
-                        logger.info('Reloading module and instance')
-                        try:
-                            INSTANCE.__exit__(None,None,None)
-                            logger.debug('Exiting INSTANCE instance')
-                        except:
-                            logger.debug('INSTANCE instance has no __exit__')
-                        INSTANCE = [] # Used to signify error state in dispatch
-                        importlib.reload(MODULE)
-                        INSTANCE = getattr(MODULE,CONFIG[1])()
+                        reload_instance()
+                    check_profile()
+                    beat('idle')
 
             except KeyboardInterrupt:
                 pass
@@ -140,6 +317,8 @@ def main(name,config,queue,log_queue,loglevel):
             except:
                 logger.exception('Unhandled error in main loop')
     finally:
+        if PROFILE:
+            finish_profile()
         try:
             INSTANCE.__exit__(None,None,None)
             logger.debug('Exiting INSTANCE instance')